@@ -5,38 +5,45 @@
 # Binance, Binance Alpha, Bybit, MEXC, KuCoin, OKX, Gate, Bitget
 # Burst mạnh (10 tin, cách 2s), lặp 30s tới khi ACK. Không dùng CoinGecko.
 
-import os, json, time, asyncio, re
-from typing import Dict, Any, List, Tuple, Optional
-import requests
+from __future__ import annotations
+
+import time
+_BOOT_T0 = time.perf_counter()
+
+import os, sys, json, asyncio, re, threading, hashlib, csv, io, contextvars, functools, glob, itertools
+from collections import deque, Counter
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FutureTimeout
+from concurrent.futures import wait as futures_wait
+from contextlib import contextmanager
+from typing import Dict, Any, List, Tuple, Optional, Callable, TYPE_CHECKING
 
 from dotenv import load_dotenv
-from telegram import (
-    Update, BotCommand, BotCommandScopeAllPrivateChats, BotCommandScopeAllGroupChats,
-    InlineKeyboardButton, InlineKeyboardMarkup
-)
-from telegram.error import TimedOut, RetryAfter, NetworkError
-
-# ===== PTB (telegram.ext) =====
-# Với PTB v20.x (môi trường của bạn), các import dưới đây đều có.
-# Nếu bạn hạ cấp về v13 thì sẽ khác, nhưng hiện tại không cần.
-from telegram.ext import (
-    Application, CommandHandler, MessageHandler, ContextTypes, filters, JobQueue,
-    CallbackQueryHandler
-)
-
-# ===== Tùy phiên bản: Defaults có thể không tồn tại =====
-try:
-    from telegram import Defaults as _Defaults
-    _HAS_DEFAULTS = True
-except Exception:
-    _HAS_DEFAULTS = False
-
-# ===== Tùy phiên bản: HTTPXRequest có thể không tồn tại =====
-try:
-    from telegram.request import HTTPXRequest as _HTTPXRequest
-    _HAS_HTTPX = True
-except Exception:
-    _HAS_HTTPX = False
+
+# ===== PTB (telegram.ext) / requests: import lười =====
+# telegram & requests khá nặng: chỉ import khi thật sự cần (main(), lần fetch đầu...).
+# Với PTB v20.x (môi trường của bạn), các import trong main() đều có.
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
+
+# ===== Startup profiling (--profile-startup) =====
+STARTUP_PHASES: List[Tuple[str, float]] = []
+
+@contextmanager
+def startup_phase(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_PHASES.append((name, time.perf_counter() - t0))
+
+def startup_report() -> str:
+    total = sum(dt for _, dt in STARTUP_PHASES)
+    lines = ["Startup profile:"]
+    for name, dt in STARTUP_PHASES:
+        lines.append(f"  {name:<28} {dt*1000:8.1f} ms  {dt/total:6.1%}" if total else f"  {name:<28} {dt*1000:8.1f} ms")
+    lines.append(f"  {'total':<28} {total*1000:8.1f} ms")
+    return "\n".join(lines)
 
 
 # ===== ENV =====
@@ -48,10 +55,34 @@ ALARM_GAP_SEC = float(os.getenv("ALARM_GAP_SEC", "2"))
 ALARM_COOLDOWN_SEC = int(os.getenv("ALARM_COOLDOWN_SEC", "30"))
 REARM_GAP_PCT = float(os.getenv("REARM_GAP_PCT", "0.002"))
 ALLOWED_CHAT_IDS = [int(x) for x in os.getenv("ALLOWED_CHAT_IDS", "").split(",") if x.strip().lstrip("-").isdigit()]
+ADMIN_CHAT_IDS = [int(x) for x in os.getenv("ADMIN_CHAT_IDS", "").split(",") if x.strip().lstrip("-").isdigit()]
+
+# Quota mỗi chat (0 = không giới hạn) & giao tin công bằng giữa các chat
+CHAT_MAX_ALERTS = int(os.getenv("CHAT_MAX_ALERTS", "200"))
+CHAT_MAX_BURSTS = int(os.getenv("CHAT_MAX_BURSTS", "3"))
+CHAT_MSGS_PER_MIN = int(os.getenv("CHAT_MSGS_PER_MIN", "40"))
+DELIVERY_RATE = float(os.getenv("DELIVERY_RATE", "25"))  # tin/giây cho toàn bot
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "8"))
+# CHAT_WEIGHTS=-1001234567890:3,123456789:0.5  (mặc định 1)
+CHAT_WEIGHTS = {int(k): float(v) for k, v in
+                (x.strip().split(":", 1) for x in os.getenv("CHAT_WEIGHTS", "").split(",") if ":" in x)}
 
 DATA_FILE = "alerts.json"
-SESSION = requests.Session()
-SESSION.headers.update({"User-Agent": "price-alert-bot/2.3"})
+STORE_SCHEMA = 2
+SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def http_session():
+    """requests.Session tạo ở lần fetch đầu tiên (import requests ra khỏi đường boot)."""
+    global SESSION
+    if SESSION is None:
+        with _SESSION_LOCK:
+            if SESSION is None:
+                import requests
+                sess = requests.Session()
+                sess.headers.update({"User-Agent": "price-alert-bot/2.3"})
+                SESSION = sess
+    return SESSION
 
 # QUOTES dùng cho chuyển đổi định dạng (bao gồm BTC/ETH để hỗ trợ cặp chéo)
 KNOWN_QUOTES = ["USDT", "USDC", "FDUSD", "BUSD", "BTC", "ETH"]
@@ -60,12 +91,139 @@ QUOTE_SUFFIXES = ["USDT", "USDC", "FDUSD", "BUSD", "USD", "TUSD"]
 # Thứ tự ưu tiên khi tự nối
 TRY_QUOTES = ["USDT", "USDC", "FDUSD"]
 
+# ===== Profiling (opt-in) =====
+# span(name) ghi cây thời gian theo contextvars (đi theo task & asyncio.to_thread).
+# Mỗi tick price_job là 1 cây gốc; giữ PROFILE_KEEP_TICKS tick gần nhất và dump ra file
+# khi 1 tick chậm hơn PROFILE_SLOW_TICK_SEC. Span ngoài tick chỉ cộng dồn vào SPAN_STATS.
+PROFILE_ON = os.getenv("PROFILE_ENABLED", "0") == "1"
+PROFILE_KEEP_TICKS = int(os.getenv("PROFILE_KEEP_TICKS", "20"))
+PROFILE_SLOW_TICK_SEC = float(os.getenv("PROFILE_SLOW_TICK_SEC", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_DUMP_GAP_SEC = float(os.getenv("PROFILE_DUMP_GAP_SEC", "300"))  # tối thiểu giữa 2 dump "slow"
+PROFILE_KEEP_FILES = int(os.getenv("PROFILE_KEEP_FILES", "20"))        # mỗi loại file chỉ giữ N file mới nhất
+PROFILE_SAMPLE_MS = float(os.getenv("PROFILE_SAMPLE_MS", "10"))
+
+TICK_HISTORY: deque = deque(maxlen=PROFILE_KEEP_TICKS)
+SPAN_STATS: Dict[str, List[float]] = {}  # name -> [count, total, max]
+_SPAN_LOCK = threading.Lock()
+_SPAN: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("span", default=None)
+_LAST_SLOW_DUMP = 0.0
+_DUMP_SEQ = itertools.count(1)
+
+@contextmanager
+def span(name: str, root: bool = False):
+    """Đo 1 đoạn code; yield node (None nếu đang tắt profiling)."""
+    if not PROFILE_ON:
+        yield None
+        return
+    parent = None if root else _SPAN.get()
+    node = {"name": name, "t": time.time(), "dur": 0.0, "children": []}
+    if parent is not None:
+        parent["children"].append(node)
+    token = _SPAN.set(node)
+    t0 = time.perf_counter()
+    try:
+        yield node
+    finally:
+        node["dur"] = time.perf_counter() - t0
+        _SPAN.reset(token)
+        with _SPAN_LOCK:
+            st = SPAN_STATS.setdefault(name, [0, 0.0, 0.0])
+            st[0] += 1; st[1] += node["dur"]; st[2] = max(st[2], node["dur"])
+
+def traced(name: str):
+    """Decorator: bọc cả hàm (sync hoặc async) trong span(name)."""
+    def deco(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def awrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return awrapper
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def profile_path(prefix: str, ext: str) -> str:
+    """Đường dẫn file mới trong PROFILE_DIR (tên duy nhất: ms + số thứ tự); xoá file cũ cùng loại
+    để chỉ còn PROFILE_KEEP_FILES file."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if PROFILE_KEEP_FILES > 0:
+        old = sorted(glob.glob(os.path.join(PROFILE_DIR, f"{prefix}_*{ext}")), key=os.path.getmtime)
+        for f in old[:max(0, len(old) - PROFILE_KEEP_FILES + 1)]:
+            try: os.remove(f)
+            except OSError: pass
+    now = time.time()
+    stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now*1000)%1000:03d}"
+    return os.path.join(PROFILE_DIR, f"{prefix}_{stamp}-{next(_DUMP_SEQ)}{ext}")
+
+def dump_ticks(reason: str) -> str:
+    path = profile_path("ticks", f"_{reason}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"reason": reason, "slow_tick_sec": PROFILE_SLOW_TICK_SEC,
+                   "ticks": list(TICK_HISTORY)}, f, ensure_ascii=False, indent=1)
+    return path
+
+def record_tick(node: Dict[str, Any]):
+    global _LAST_SLOW_DUMP
+    TICK_HISTORY.append(node)
+    if PROFILE_SLOW_TICK_SEC > 0 and node["dur"] >= PROFILE_SLOW_TICK_SEC:
+        # Sàn chậm kéo dài: mỗi tick đều chậm, nhưng 1 dump/PROFILE_DUMP_GAP_SEC là đủ
+        # (ring buffer đã chứa các tick trước đó)
+        if time.monotonic() - _LAST_SLOW_DUMP < PROFILE_DUMP_GAP_SEC: return
+        _LAST_SLOW_DUMP = time.monotonic()
+        try: dump_ticks("slow")
+        except Exception: pass
+
+# Sampling profiler: thread nền chụp stack mọi thread, ghi dạng "collapsed" (flamegraph.pl/speedscope)
+SAMPLES: Counter = Counter()
+_SAMPLER: Optional[threading.Thread] = None
+_SAMPLER_STOP = threading.Event()
+
+def _sampler_run(interval: float):
+    me = threading.get_ident()
+    while not _SAMPLER_STOP.wait(interval):
+        for tid, frame in sys._current_frames().items():
+            if tid == me: continue
+            stack = []
+            while frame is not None:
+                co = frame.f_code
+                stack.append(f"{co.co_name} ({os.path.basename(co.co_filename)}:{co.co_firstlineno})")
+                frame = frame.f_back
+            SAMPLES[";".join(reversed(stack))] += 1
+
+def sampler_start() -> bool:
+    global _SAMPLER
+    if _SAMPLER is not None and _SAMPLER.is_alive(): return False
+    SAMPLES.clear(); _SAMPLER_STOP.clear()
+    _SAMPLER = threading.Thread(target=_sampler_run, args=(PROFILE_SAMPLE_MS / 1000.0,),
+                                name="sampler", daemon=True)
+    _SAMPLER.start()
+    return True
+
+def sampler_stop() -> Tuple[Optional[str], List[Tuple[str, int]]]:
+    """Dừng sampler, ghi file collapsed stacks; trả (path, top frame lá)."""
+    global _SAMPLER
+    if _SAMPLER is None: return None, []
+    _SAMPLER_STOP.set(); _SAMPLER.join(timeout=2); _SAMPLER = None
+    path = profile_path("samples", ".folded")
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, n in SAMPLES.most_common():
+            f.write(f"{stack} {n}\n")
+    leaves: Counter = Counter()
+    for stack, n in SAMPLES.items():
+        leaves[stack.rsplit(";", 1)[-1]] += n
+    return path, leaves.most_common(10)
+
 # ===== Cache =====
 PRICE_CACHE_TTL = int(os.getenv("PRICE_CACHE_TTL", "120"))
 PRICE_CACHE: Dict[Tuple[str,str], Tuple[float,float]] = {}
 
-def cache_set(src: str, code: str, price: float):
-    PRICE_CACHE[(src, code)] = (float(price), time.time())
+def cache_set(src: str, code: str, price: float, ts: Optional[float] = None):
+    PRICE_CACHE[(src, code)] = (float(price), ts if ts is not None else time.time())
 
 def cache_get(src: str, code: str):
     v = PRICE_CACHE.get((src, code))
@@ -132,27 +290,27 @@ def normalize_prefix(p: str) -> Optional[str]:
     return CANONICALS.get(s)
 
 # ===== Providers =====
-def get_price_binance(symbol: str) -> float:
+def get_price_binance(symbol: str, host: str = "https://api.binance.com") -> float:
     symbol = normalize_no_dash(symbol)
-    r = SESSION.get("https://api.binance.com/api/v3/ticker/price",
+    r = http_session().get(host + "/api/v3/ticker/price",
                     params={"symbol": symbol}, timeout=6)
     r.raise_for_status()
     j = r.json()
     if "price" not in j: raise ValueError("Binance: invalid response")
     return float(j["price"])
 
-def get_price_binance_alpha(symbol: str) -> float:
+def get_price_binance_alpha(symbol: str, host: str = "https://api1.binance.com") -> float:
     symbol = normalize_no_dash(symbol)
-    r = SESSION.get("https://api1.binance.com/api/v3/ticker/price",
+    r = http_session().get(host + "/api/v3/ticker/price",
                     params={"symbol": symbol}, timeout=6)
     r.raise_for_status()
     j = r.json()
     if "price" not in j: raise ValueError("Binance Alpha: invalid response")
     return float(j["price"])
 
-def get_price_bybit(symbol: str) -> float:
+def get_price_bybit(symbol: str, host: str = "https://api.bybit.com") -> float:
     symbol = normalize_no_dash(symbol)
-    r = SESSION.get("https://api.bybit.com/v5/market/tickers",
+    r = http_session().get(host + "/v5/market/tickers",
                     params={"category":"spot","symbol":symbol}, timeout=6)
     r.raise_for_status()
     j = r.json()
@@ -162,18 +320,18 @@ def get_price_bybit(symbol: str) -> float:
     if not price_str: raise ValueError("Bybit: invalid price")
     return float(price_str)
 
-def get_price_mexc(symbol: str) -> float:
+def get_price_mexc(symbol: str, host: str = "https://api.mexc.com") -> float:
     symbol = normalize_no_dash(symbol)
-    r = SESSION.get("https://api.mexc.com/api/v3/ticker/price",
+    r = http_session().get(host + "/api/v3/ticker/price",
                     params={"symbol": symbol}, timeout=6)
     r.raise_for_status()
     j = r.json()
     if "price" not in j: raise ValueError("MEXC: invalid response")
     return float(j["price"])
 
-def get_price_kucoin(symbol: str) -> float:
+def get_price_kucoin(symbol: str, host: str = "https://api.kucoin.com") -> float:
     symbol = undash_to_dash(symbol)
-    r = SESSION.get("https://api.kucoin.com/api/v1/market/orderbook/level1",
+    r = http_session().get(host + "/api/v1/market/orderbook/level1",
                     params={"symbol": symbol}, timeout=6)
     r.raise_for_status()
     j = r.json()
@@ -183,9 +341,9 @@ def get_price_kucoin(symbol: str) -> float:
     if not price: raise ValueError("KuCoin: invalid price")
     return float(price)
 
-def get_price_okx(symbol: str) -> float:
+def get_price_okx(symbol: str, host: str = "https://www.okx.com") -> float:
     symbol = undash_to_dash(symbol)
-    r = SESSION.get("https://www.okx.com/api/v5/market/ticker",
+    r = http_session().get(host + "/api/v5/market/ticker",
                     params={"instId": symbol}, timeout=6)
     r.raise_for_status()
     j = r.json()
@@ -195,9 +353,9 @@ def get_price_okx(symbol: str) -> float:
     if not last: raise ValueError("OKX: invalid price")
     return float(last)
 
-def get_price_gate(symbol: str) -> float:
+def get_price_gate(symbol: str, host: str = "https://api.gateio.ws") -> float:
     pair = to_gate_pair(symbol)
-    r = SESSION.get("https://api.gateio.ws/api/v4/spot/tickers",
+    r = http_session().get(host + "/api/v4/spot/tickers",
                     params={"currency_pair": pair}, timeout=6)
     r.raise_for_status()
     j = r.json()
@@ -207,7 +365,7 @@ def get_price_gate(symbol: str) -> float:
     if not last: raise ValueError("Gate: invalid price")
     return float(last)
 
-def get_price_bitget(symbol: str) -> float:
+def get_price_bitget(symbol: str, host: str = "https://api.bitget.com") -> float:
     # Bitget yêu cầu dạng BTCUSDT; nếu thiếu quote -> mặc định USDT
     sym = normalize_no_dash(symbol)
     if not any(sym.endswith(q) for q in QUOTE_SUFFIXES):
@@ -215,13 +373,13 @@ def get_price_bitget(symbol: str) -> float:
 
     # Thử 2 endpoint; khi nhận list thì lọc đúng symbol
     url_try = [
-        ("https://api.bitget.com/api/spot/v1/market/ticker", {"symbol": sym}, False),
-        ("https://api.bitget.com/api/spot/v1/market/tickers", {"symbol": sym}, True),
+        (host + "/api/spot/v1/market/ticker", {"symbol": sym}, False),
+        (host + "/api/spot/v1/market/tickers", {"symbol": sym}, True),
     ]
     last_err = None
     for url, params, is_list in url_try:
         try:
-            r = SESSION.get(url, params=params, timeout=6)
+            r = http_session().get(url, params=params, timeout=6)
             r.raise_for_status()
             j = r.json()
             data = j.get("data")
@@ -243,20 +401,85 @@ def get_price_bitget(symbol: str) -> float:
                     px = data.get("close") or data.get("lastPr")
                     if px: return float(px)
         except Exception as e:
+            if is_exchange_failure(e):
+                raise  # mạng/5xx/429: endpoint thứ 2 cùng host cũng sẽ lỗi; để breaker ghi nhận
             last_err = e
             continue
     raise ValueError(f"Bitget: not found for {sym} ({last_err})")
 
-# dispatch
-PROVIDERS = {
-    "binance": get_price_binance,
-    "binance_alpha": get_price_binance_alpha,
-    "bybit": get_price_bybit,
-    "mexc": get_price_mexc,
-    "kucoin": get_price_kucoin,
-    "okx": get_price_okx,
-    "gate": get_price_gate,
-    "bitget": get_price_bitget,
+# ===== Snapshots (toàn bộ ticker của 1 sàn trong 1 request, dùng cho import hàng loạt) =====
+# Key trả về cùng định dạng code của sàn đó (BTCUSDT / BTC-USDT / BTC_USDT).
+def snapshot_binance(host: str = "https://api.binance.com") -> Dict[str, float]:
+    r = http_session().get(host + "/api/v3/ticker/price", timeout=15)
+    r.raise_for_status()
+    return {it["symbol"]: float(it["price"]) for it in r.json() if it.get("price")}
+
+def snapshot_bybit(host: str = "https://api.bybit.com") -> Dict[str, float]:
+    r = http_session().get(host + "/v5/market/tickers", params={"category":"spot"}, timeout=15)
+    r.raise_for_status()
+    j = r.json()
+    if j.get("retCode")!=0 or not j.get("result"):
+        raise ValueError("Bybit: invalid snapshot")
+    return {it["symbol"]: float(it["lastPrice"]) for it in j["result"].get("list", []) if it.get("lastPrice")}
+
+def snapshot_mexc(host: str = "https://api.mexc.com") -> Dict[str, float]:
+    r = http_session().get(host + "/api/v3/ticker/price", timeout=15)
+    r.raise_for_status()
+    return {it["symbol"]: float(it["price"]) for it in r.json() if it.get("price")}
+
+def snapshot_kucoin(host: str = "https://api.kucoin.com") -> Dict[str, float]:
+    r = http_session().get(host + "/api/v1/market/allTickers", timeout=15)
+    r.raise_for_status()
+    j = r.json()
+    if j.get("code") != "200000" or not j.get("data"):
+        raise ValueError("KuCoin: invalid snapshot")
+    return {it["symbol"]: float(it["last"]) for it in j["data"].get("ticker", []) if it.get("last")}
+
+def snapshot_okx(host: str = "https://www.okx.com") -> Dict[str, float]:
+    r = http_session().get(host + "/api/v5/market/tickers", params={"instType":"SPOT"}, timeout=15)
+    r.raise_for_status()
+    j = r.json()
+    if j.get("code") != "0":
+        raise ValueError("OKX: invalid snapshot")
+    return {it["instId"]: float(it["last"]) for it in j.get("data", []) if it.get("last")}
+
+def snapshot_gate(host: str = "https://api.gateio.ws") -> Dict[str, float]:
+    r = http_session().get(host + "/api/v4/spot/tickers", timeout=15)
+    r.raise_for_status()
+    j = r.json()
+    if not isinstance(j, list):
+        raise ValueError("Gate: invalid snapshot")
+    return {it["currency_pair"]: float(it["last"]) for it in j if it.get("last")}
+
+def snapshot_bitget(host: str = "https://api.bitget.com") -> Dict[str, float]:
+    r = http_session().get(host + "/api/spot/v1/market/tickers", timeout=15)
+    r.raise_for_status()
+    out: Dict[str, float] = {}
+    for it in r.json().get("data") or []:
+        s = (it.get("symbol") or it.get("instId") or "").upper()
+        px = it.get("close") or it.get("lastPr")
+        if s and px: out[s] = float(px)
+    return out
+
+# dispatch: fn(symbol, host); hosts[0] là host chính, phần còn lại là mirror dùng để hedge;
+# snapshot(host) trả toàn bộ ticker của sàn
+PROVIDERS: Dict[str, Dict[str, Any]] = {
+    "binance":       {"fn": get_price_binance, "snapshot": snapshot_binance, "hedge": True,
+                      "hosts": ["https://api.binance.com", "https://api-gcp.binance.com"]},
+    "binance_alpha": {"fn": get_price_binance_alpha, "snapshot": snapshot_binance, "hedge": True,
+                      "hosts": ["https://api1.binance.com", "https://api2.binance.com", "https://api3.binance.com"]},
+    "bybit":         {"fn": get_price_bybit, "snapshot": snapshot_bybit, "hedge": True,
+                      "hosts": ["https://api.bybit.com", "https://api.bytick.com"]},
+    "mexc":          {"fn": get_price_mexc, "snapshot": snapshot_mexc, "hedge": False,
+                      "hosts": ["https://api.mexc.com"]},
+    "kucoin":        {"fn": get_price_kucoin, "snapshot": snapshot_kucoin, "hedge": False,
+                      "hosts": ["https://api.kucoin.com"]},
+    "okx":           {"fn": get_price_okx, "snapshot": snapshot_okx, "hedge": True,
+                      "hosts": ["https://www.okx.com", "https://aws.okx.com"]},
+    "gate":          {"fn": get_price_gate, "snapshot": snapshot_gate, "hedge": False,
+                      "hosts": ["https://api.gateio.ws"]},
+    "bitget":        {"fn": get_price_bitget, "snapshot": snapshot_bitget, "hedge": False,
+                      "hosts": ["https://api.bitget.com"]},
 }
 
 def provider_display_name(src: str) -> str:
@@ -271,16 +494,235 @@ def provider_display_name(src: str) -> str:
         "bitget": "Bitget",
     }.get(src, src.capitalize())
 
-def get_price_resolved(src: str, code: str) -> float:
+# ===== Circuit breaker & health =====
+# Mỗi sàn: closed -> (lỗi liên tiếp >= ngưỡng) -> open -> (hết CB_OPEN_SEC) -> half_open (1 probe).
+# Chỉ lỗi mạng/5xx/429 mới tính là sàn lỗi; "không có cặp" vẫn là sàn khỏe.
+CB_FAIL_THRESHOLD = int(os.getenv("CB_FAIL_THRESHOLD", "3"))
+CB_OPEN_SEC = float(os.getenv("CB_OPEN_SEC", "60"))
+HEALTH_SLOW_SEC = float(os.getenv("HEALTH_SLOW_SEC", "2"))
+HEALTH_ERR_RATE = float(os.getenv("HEALTH_ERR_RATE", "0.3"))
+HEALTH_ALPHA = 0.2
+HEALTH_WINDOW = 50
+HEALTH: Dict[str, Dict[str, Any]] = {}
+_HEALTH_LOCK = threading.Lock()
+
+class CircuitOpen(ValueError):
+    pass
+
+def _health(src: str) -> Dict[str, Any]:
+    return HEALTH.setdefault(src, {"state": "closed", "fails": 0, "opened_at": 0.0,
+                                   "probing": False, "lat": 0.0, "err": 0.0,
+                                   "samples": deque(maxlen=HEALTH_WINDOW),
+                                   "hedged": 0, "hedge_wins": 0})
+
+def is_exchange_failure(e: BaseException) -> bool:
+    import requests
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(e, requests.HTTPError):
+        code = getattr(e.response, "status_code", None)
+        return code is None or code >= 500 or code == 429
+    return False
+
+def breaker_acquire(src: str):
+    """Raise CircuitOpen ngay nếu sàn đang bị ngắt (trừ lượt probe half-open)."""
+    with _HEALTH_LOCK:
+        h = _health(src)
+        if h["state"] == "closed":
+            return
+        if h["state"] == "open" and time.time() - h["opened_at"] >= CB_OPEN_SEC:
+            h["state"] = "half_open"; h["probing"] = False
+        if h["state"] == "half_open" and not h["probing"]:
+            h["probing"] = True
+            return
+    raise CircuitOpen(f"{provider_display_name(src)}: tạm ngắt (circuit open)")
+
+def health_record(src: str, latency: Optional[float], err: Optional[BaseException] = None):
+    """latency=None: chỉ ghi thành công/lỗi cho breaker (vd. snapshot), không đụng lat/samples."""
+    failed = err is not None and is_exchange_failure(err)
+    with _HEALTH_LOCK:
+        h = _health(src)
+        if latency is not None:
+            h["lat"] = latency if not h["lat"] else h["lat"]*(1-HEALTH_ALPHA) + latency*HEALTH_ALPHA
+        h["err"] = h["err"]*(1-HEALTH_ALPHA) + (HEALTH_ALPHA if failed else 0.0)
+        h["probing"] = False
+        if failed:
+            h["fails"] += 1
+            if h["state"] == "half_open" or h["fails"] >= CB_FAIL_THRESHOLD:
+                h["state"] = "open"; h["opened_at"] = time.time()
+        else:
+            h["fails"] = 0; h["state"] = "closed"
+            if latency is not None: h["samples"].append(latency)
+
+def health_tier(src: str) -> int:
+    """0 = khỏe (kể cả sàn chưa gọi lần nào), 1 = xuống cấp (lỗi nhiều / chậm hẳn), 2 = đang open."""
+    h = HEALTH.get(src)
+    if not h: return 0
+    if h["state"] == "open" and time.time() - h["opened_at"] < CB_OPEN_SEC: return 2
+    if h["err"] > HEALTH_ERR_RATE: return 1
+    if HEALTH_SLOW_SEC > 0 and h["lat"] > HEALTH_SLOW_SEC: return 1
+    return 0
+
+def rank_candidates(cands: List[Tuple[str,str]]) -> List[Tuple[str,str]]:
+    """Đẩy sàn xuống cấp/đang ngắt ra sau; sàn khỏe giữ nguyên thứ tự ưu tiên gốc."""
+    ranked = sorted(enumerate(cands), key=lambda ic: (health_tier(ic[1][0]), ic[0]))
+    return [c for _, c in ranked]
+
+def latency_p95(src: str) -> Optional[float]:
+    with _HEALTH_LOCK:
+        xs = sorted(HEALTH.get(src, {}).get("samples", ()))
+    if len(xs) < 5: return None
+    return xs[min(len(xs)-1, int(len(xs)*0.95))]
+
+# ===== Hedged requests =====
+# Chỉ dùng cho fetch của price_job: nếu host chính chưa trả lời sau ~p95, bắn thêm 1 request
+# sang mirror cùng sàn, lấy kết quả hợp lệ đầu tiên. requests là sync nên request thua không
+# huỷ được giữa chừng — nó bị bỏ qua và tự kết thúc trong timeout=6.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_MIN_DELAY_SEC = float(os.getenv("HEDGE_MIN_DELAY_SEC", "0.3"))
+HEDGE_DEFAULT_DELAY_SEC = float(os.getenv("HEDGE_DEFAULT_DELAY_SEC", "1.0"))
+# Mỗi hub_fetch (chạy trong default executor: min(32, cpu+4) thread) có thể giữ 2 worker
+# (primary + backup), nên pool mặc định gấp đôi số caller đồng thời.
+_HEDGE_CALLERS = min(32, (os.cpu_count() or 1) + 4)
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=max(2 * _HEDGE_CALLERS, int(os.getenv("HEDGE_WORKERS", "0"))),
+                                 thread_name_prefix="hedge")
+
+def hedge_delay(src: str) -> float:
+    p95 = latency_p95(src)
+    return HEDGE_DEFAULT_DELAY_SEC if p95 is None else max(HEDGE_MIN_DELAY_SEC, p95)
+
+def _attempt(src: str, code: str, host: str, started: Optional[threading.Event] = None) -> float:
+    if started is not None: started.set()
+    t0 = time.monotonic()
+    try:
+        price = float(PROVIDERS[src]["fn"](code, host))
+    except Exception as e:
+        health_record(src, time.monotonic() - t0, e)
+        raise
+    health_record(src, time.monotonic() - t0)
+    return price
+
+def call_provider(src: str, code: str, hedge: bool = False) -> float:
+    breaker_acquire(src)
+    prov = PROVIDERS[src]; hosts = prov["hosts"]
+    if not (hedge and HEDGE_ENABLED and prov.get("hedge") and len(hosts) > 1):
+        return _attempt(src, code, hosts[0])
+
+    # Đếm giờ hedge từ lúc request chính thực sự chạy, không tính thời gian xếp hàng trong pool
+    started = threading.Event()
+    primary = _HEDGE_POOL.submit(_attempt, src, code, hosts[0], started)
+    started.wait()
+    try:
+        return primary.result(timeout=hedge_delay(src))
+    except FutureTimeout:
+        pass
+    except Exception as e:
+        if not is_exchange_failure(e): raise  # mirror cũng sẽ trả "không có cặp"
+    last_err: Optional[BaseException] = None
+    if primary.done():
+        # Có thể vừa xong ngay sau timeout: có giá thì dùng luôn, không hedge
+        last_err = primary.exception()
+        if last_err is None: return primary.result()
+        if not is_exchange_failure(last_err): raise last_err
+    with _HEALTH_LOCK:
+        _health(src)["hedged"] += 1
+    backup = _HEDGE_POOL.submit(_attempt, src, code, hosts[1])
+    pending = {backup} if primary.done() else {primary, backup}
+    while pending:
+        done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                for other in pending: other.cancel()
+                if f is backup:
+                    with _HEALTH_LOCK:
+                        _health(src)["hedge_wins"] += 1
+                return f.result()
+            last_err = f.exception()
+    raise last_err
+
+def fetch_snapshot(src: str) -> Dict[str, float]:
+    # Latency tải cả sàn không so được với request 1 cặp: chỉ báo thành công/lỗi cho breaker
+    breaker_acquire(src)
+    try:
+        snap = PROVIDERS[src]["snapshot"](PROVIDERS[src]["hosts"][0])
+    except Exception as e:
+        health_record(src, None, e)
+        raise
+    health_record(src, None)
+    return snap
+
+# ===== Price hub (pub/sub) =====
+# Producer (poller, /price, /find...) publish (src, code, price, ts); subscriber nhận lại.
+# Mỗi cặp chỉ có 1 request đang bay: ai hỏi cùng lúc sẽ chờ chung kết quả đó.
+PriceSubscriber = Callable[[str, str, float, float], None]
+HUB_SUBS: List[PriceSubscriber] = []
+HUB_INFLIGHT: Dict[Tuple[str,str], Future] = {}
+_HUB_LOCK = threading.Lock()
+
+def hub_subscribe(fn: PriceSubscriber) -> PriceSubscriber:
+    if fn not in HUB_SUBS:
+        HUB_SUBS.append(fn)
+    return fn
+
+def hub_unsubscribe(fn: PriceSubscriber):
+    if fn in HUB_SUBS:
+        HUB_SUBS.remove(fn)
+
+def hub_publish(src: str, code: str, price: float, ts: Optional[float] = None):
+    """Ghi cache rồi phát cho mọi subscriber (có thể gọi từ thread worker)."""
+    ts = ts if ts is not None else time.time()
+    cache_set(src, code, price, ts)
+    for fn in list(HUB_SUBS):
+        try: fn(src, code, float(price), ts)
+        except Exception: pass
+
+def hub_get(src: str, code: str, replay: bool = False, hedge: bool = False) -> float:
+    """Lấy giá đồng bộ: cache -> request đang bay -> gọi provider (rồi publish).
+    replay=True: cache hit vẫn phát lại cho subscriber (poller dùng để giữ nhịp re-burst).
+    hedge=True: cho phép hedge sang mirror (chỉ poller dùng)."""
     cp, ts = cache_get(src, code)
     if cp is not None:
+        if replay: hub_publish(src, code, cp, ts)
         return cp
     if src not in PROVIDERS:
         raise ValueError("Unknown source")
-    price = PROVIDERS[src](code)
-    cache_set(src, code, price)
+    key = (src, code)
+    with _HUB_LOCK:
+        fut = HUB_INFLIGHT.get(key)
+        owner = fut is None
+        if owner:
+            fut = HUB_INFLIGHT[key] = Future()
+    if not owner:
+        return fut.result()
+    # Ghi cache/publish & trả kết quả cho người chờ TRƯỚC khi gỡ request đang bay,
+    # để không có khe nào mà cache trống lẫn không còn request để chờ chung.
+    try:
+        price = call_provider(src, code, hedge)
+        charge_fetch(src, code)
+        hub_publish(src, code, price)
+        fut.set_result(price)
+    except Exception as e:
+        if not isinstance(e, CircuitOpen):
+            charge_fetch(src, code)  # request đã thật sự gửi đi, lỗi vẫn tốn
+        if not fut.done(): fut.set_exception(e)
+        raise
+    finally:
+        with _HUB_LOCK:
+            HUB_INFLIGHT.pop(key, None)
     return price
 
+async def hub_fetch(src: str, code: str, replay: bool = False, hedge: bool = False) -> float:
+    """Bản async của hub_get: không chặn event loop, dùng chung request đang bay."""
+    cp, _ = cache_get(src, code)
+    if cp is None:
+        fut = HUB_INFLIGHT.get((src, code))
+        if fut is not None:
+            return await asyncio.wrap_future(fut)
+    return await asyncio.to_thread(hub_get, src, code, replay, hedge)
+
+def get_price_resolved(src: str, code: str) -> float:
+    return hub_get(src, code)
+
 def format_symbol_for_display(src: str, code: str) -> str:
     if src in ("kucoin","okx"):
         return undash_to_dash(code)
@@ -319,10 +761,13 @@ def _codes_for_src_with_fallback(src: str, body: str) -> List[str]:
     return out
 
 # ===== Resolve asset =====
-def try_first_available(cands: List[Tuple[str, str]]) -> Tuple[str,str,str]:
-    for src, code in cands:
+PriceProbe = Callable[[str, str], float]
+
+def try_first_available(cands: List[Tuple[str, str]], probe: Optional[PriceProbe] = None) -> Tuple[str,str,str]:
+    probe = probe or get_price_resolved
+    for src, code in rank_candidates(cands):
         try:
-            _ = get_price_resolved(src, code)
+            _ = probe(src, code)
             name = provider_display_name(src)
             disp = f"{format_symbol_for_display(src, code)} ({name})"
             return src, code, disp
@@ -330,7 +775,10 @@ def try_first_available(cands: List[Tuple[str, str]]) -> Tuple[str,str,str]:
             continue
     raise ValueError("Không tìm thấy cặp trên các sàn hỗ trợ (Binance/Bybit/MEXC/KuCoin/OKX/Gate/Bitget)")
 
-def resolve_asset(raw: str) -> Tuple[str,str,str]:
+@traced("resolve_asset")
+def resolve_asset(raw: str, probe: Optional[PriceProbe] = None) -> Tuple[str,str,str]:
+    """probe(src, code) kiểm tra cặp có giá hay không (mặc định: get_price_resolved)."""
+    probe = probe or get_price_resolved
     x = raw.strip()
     # Cho phép "prefix: body" hoặc "prefix body"
     if ":" in x or re.search(r"\s+\S+", x):
@@ -349,7 +797,7 @@ def resolve_asset(raw: str) -> Tuple[str,str,str]:
             last_err = None
             for code in codes:
                 try:
-                    _ = get_price_resolved(p, code)
+                    _ = probe(p, code)
                     return p, code, f"{format_symbol_for_display(p, code)} ({provider_display_name(p)})"
                 except Exception as e:
                     last_err = e
@@ -372,7 +820,7 @@ def resolve_asset(raw: str) -> Tuple[str,str,str]:
             ("okx",     undash_to_dash(base)),
             ("gate",    to_gate_pair(base)),
         ]
-        return try_first_available(cands)
+        return try_first_available(cands, probe)
 
     for q in TRY_QUOTES:
         cand = base + q
@@ -387,14 +835,16 @@ def resolve_asset(raw: str) -> Tuple[str,str,str]:
             ("gate",    to_gate_pair(cand)),
         ]
         try:
-            return try_first_available(cands)
+            return try_first_available(cands, probe)
         except Exception:
             continue
     raise ValueError("Không tự động nhận diện được cặp. Ví dụ: binance:EDENUSDT | kucoin:EDEN-USDT | gate:EDEN_USDT")
 
 # ===== Utils: Telegram safe send =====
+@traced("send_safe")
 async def send_safe(bot, chat_id: int, text: str, reply_markup=None) -> bool:
     """Gửi 1 tin với retry khi gặp TimedOut/RetryAfter/NetworkError."""
+    from telegram.error import TimedOut, RetryAfter, NetworkError
     for _ in range(4):  # tối đa 4 lần
         try:
             await bot.send_message(chat_id=chat_id, text=text, disable_notification=False, reply_markup=reply_markup)
@@ -408,6 +858,7 @@ async def send_safe(bot, chat_id: int, text: str, reply_markup=None) -> bool:
     return False
 
 async def safe_reply(message, text):
+    from telegram.error import TimedOut, RetryAfter, NetworkError
     try:
         await message.reply_text(text)
     except RetryAfter as e:
@@ -419,21 +870,145 @@ async def safe_reply(message, text):
     except Exception:
         pass
 
+# ===== Per-chat accounting & quotas =====
+CHAT_USAGE: Dict[int, Dict[str, float]] = {}
+ACTIVE_BURSTS: Dict[int, int] = {}
+# Chi phí fetch chỉ tính khi thật sự gọi provider (owner path của hub_get):
+# lệnh của 1 chat (charge_to) thì chat đó trả; còn lại chia đều cho các chat theo dõi cặp.
+PAIR_WATCHERS: Dict[Tuple[str,str], List[int]] = {}  # price_job làm mới mỗi tick
+_FETCH_CHAT: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("fetch_chat", default=None)
+_USAGE_LOCK = threading.Lock()
+
+def usage(cid: int) -> Dict[str, float]:
+    return CHAT_USAGE.setdefault(cid, {"fetch_share": 0.0, "sends": 0, "deferred": 0,
+                                       "bursts": 0, "bursts_skipped": 0})
+
+@contextmanager
+def charge_to(cid: int):
+    """Fetch phát sinh trong khối này (kể cả qua asyncio.to_thread) tính cho chat cid."""
+    token = _FETCH_CHAT.set(cid)
+    try:
+        yield
+    finally:
+        _FETCH_CHAT.reset(token)
+
+def charge_fetch(src: str, code: str):
+    cid = _FETCH_CHAT.get()
+    with _USAGE_LOCK:
+        if cid is not None:
+            usage(cid)["fetch_share"] += 1.0
+            return
+        cids = PAIR_WATCHERS.get((src, code)) or []
+        for c in cids:
+            usage(c)["fetch_share"] += 1.0 / len(cids)
+
+def chat_weight(cid: int) -> float:
+    return max(0.01, CHAT_WEIGHTS.get(cid, 1.0))
+
+def burst_reserve(cid: int) -> bool:
+    """Giữ 1 suất burst cho chat; hết suất thì alert sẽ bắn lại ở lượt sau."""
+    if CHAT_MAX_BURSTS > 0 and ACTIVE_BURSTS.get(cid, 0) >= CHAT_MAX_BURSTS:
+        usage(cid)["bursts_skipped"] += 1
+        return False
+    ACTIVE_BURSTS[cid] = ACTIVE_BURSTS.get(cid, 0) + 1
+    usage(cid)["bursts"] += 1
+    return True
+
+def burst_release(cid: int):
+    ACTIVE_BURSTS[cid] = max(0, ACTIVE_BURSTS.get(cid, 0) - 1)
+
+# ===== Fair delivery (WFQ theo chat) =====
+# Mỗi tin nhận finish tag = max(vtime, finish tin trước của chat) + 1/weight; dispatcher luôn gửi
+# tin có tag nhỏ nhất trong các chat còn quota tin/phút, với nhịp DELIVERY_RATE cho toàn bot.
+DELIVERY_QUEUES: Dict[int, deque] = {}
+_DELIVERY_LAST_FINISH: Dict[int, float] = {}
+_DELIVERY_SENT: Dict[int, deque] = {}
+_DELIVERY_VTIME = 0.0
+_DELIVERY_WAKE: Optional[asyncio.Event] = None
+_DELIVERY_TASK: Optional[asyncio.Task] = None
+
+def _chat_rate_ok(cid: int, now: float) -> bool:
+    if CHAT_MSGS_PER_MIN <= 0: return True
+    log = _DELIVERY_SENT.setdefault(cid, deque())
+    while log and now - log[0] >= 60: log.popleft()
+    return len(log) < CHAT_MSGS_PER_MIN
+
+async def deliver(bot, chat_id: int, text: str, reply_markup=None) -> bool:
+    """Xếp 1 tin vào hàng đợi công bằng rồi chờ kết quả gửi."""
+    global _DELIVERY_WAKE, _DELIVERY_TASK
+    if _DELIVERY_TASK is None or _DELIVERY_TASK.done():
+        _DELIVERY_WAKE = asyncio.Event()
+        _DELIVERY_TASK = asyncio.create_task(delivery_loop(bot))
+    fut = asyncio.get_running_loop().create_future()
+    finish = max(_DELIVERY_VTIME, _DELIVERY_LAST_FINISH.get(chat_id, 0.0)) + 1.0 / chat_weight(chat_id)
+    _DELIVERY_LAST_FINISH[chat_id] = finish
+    # [finish, text, reply_markup, fut, đã tính deferred chưa]
+    DELIVERY_QUEUES.setdefault(chat_id, deque()).append([finish, text, reply_markup, fut, False])
+    _DELIVERY_WAKE.set()
+    return await fut
+
+async def _deliver_one(sem: asyncio.Semaphore, bot, chat_id: int, text: str, reply_markup, fut: asyncio.Future):
+    try:
+        ok = await send_safe(bot, chat_id, text, reply_markup=reply_markup)
+    except Exception:
+        ok = False
+    finally:
+        sem.release()
+    if not fut.done(): fut.set_result(ok)
+
+async def delivery_loop(bot):
+    global _DELIVERY_VTIME
+    sem = asyncio.Semaphore(max(1, DELIVERY_CONCURRENCY))
+    gap = 1.0 / DELIVERY_RATE if DELIVERY_RATE > 0 else 0.0
+    while True:
+        now = time.time(); best = None
+        for cid, q in list(DELIVERY_QUEUES.items()):
+            if not q:
+                DELIVERY_QUEUES.pop(cid, None); continue
+            if not _chat_rate_ok(cid, now):
+                if not q[0][4]:
+                    q[0][4] = True; usage(cid)["deferred"] += 1
+                continue
+            if best is None or q[0][0] < DELIVERY_QUEUES[best][0][0]:
+                best = cid
+        if best is None:
+            # Rỗng: ngủ tới khi có tin; còn tin nhưng chat nào cũng hết quota: thử lại sau 1s
+            _DELIVERY_WAKE.clear()
+            try: await asyncio.wait_for(_DELIVERY_WAKE.wait(), 1.0 if DELIVERY_QUEUES else None)
+            except asyncio.TimeoutError: pass
+            continue
+        finish, text, reply_markup, fut, _ = DELIVERY_QUEUES[best].popleft()
+        _DELIVERY_VTIME = finish
+        _DELIVERY_SENT.setdefault(best, deque()).append(now)
+        usage(best)["sends"] += 1
+        await sem.acquire()
+        asyncio.create_task(_deliver_one(sem, bot, best, text, reply_markup, fut))
+        if gap: await asyncio.sleep(gap)
+
 # ===== Burst sender =====
 async def send_burst(bot, chat_id: int, text: str, alert_id: int):
+    """Gửi burst qua hàng đợi công bằng; suất burst đã được giữ bằng burst_reserve()."""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    _SPAN.set(None)  # burst sống lâu hơn tick tạo ra nó: không gắn vào cây span của tick
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton(f"✅ Đã nhận #{alert_id}", callback_data=f"ack:{alert_id}")],
         [InlineKeyboardButton(f"🔁 Unack #{alert_id}", callback_data=f"unack:{alert_id}")]
     ])
-    await send_safe(bot, chat_id, text, reply_markup=kb)
-    for _ in range(max(0, ALARM_REPEAT-1)):
-        await asyncio.sleep(ALARM_GAP_SEC)
-        await send_safe(bot, chat_id, text)
+    try:
+        await deliver(bot, chat_id, text, reply_markup=kb)
+        for _ in range(max(0, ALARM_REPEAT-1)):
+            await asyncio.sleep(ALARM_GAP_SEC)
+            await deliver(bot, chat_id, text)
+    finally:
+        burst_release(chat_id)
 
 # ===== Commands =====
 def allowed(update: Update) -> bool:
     return not ALLOWED_CHAT_IDS or (update.effective_chat and update.effective_chat.id in ALLOWED_CHAT_IDS)
 
+def is_admin(update: Update) -> bool:
+    return bool(update.effective_chat) and update.effective_chat.id in ADMIN_CHAT_IDS
+
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not allowed(update): return
     await safe_reply(update.message,
@@ -452,8 +1027,11 @@ async def cmd_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "• /price <asset> — xem giá nhanh\n"
         "• /find <asset> — xem giá trên tất cả sàn\n"
         "• /add <asset> >=|<= <giá> — tạo cảnh báo giá\n"
+        "• /addmany (mỗi dòng 1 cảnh báo) hoặc gửi file .csv/.json kèm caption /addmany\n"
+        "• /export [json|csv] — xuất cảnh báo của chat\n"
         "• /list, /remove <id>, /removeall\n"
-        "• /ack <id>, /unack <id>\n\n"
+        "• /ack <id>, /unack <id>\n"
+        "• /health — trạng thái sàn (circuit breaker, độ trễ, hedge)\n\n"
         "Ví dụ (để bot tự chọn sàn):\n"
         "  /add BTC >= 70000\n"
         "  /add SOL <= 140\n\n"
@@ -473,15 +1051,87 @@ async def cmd_id(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_ping(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not allowed(update): return
-    await safe_reply(update.message, "✅ Bot is running")
+    down = [provider_display_name(src) for src in PROVIDERS if HEALTH.get(src, {}).get("state") == "open"]
+    msg = "✅ Bot is running"
+    if down:
+        msg += "\n⚠️ Tạm ngắt: " + ", ".join(down)
+    await safe_reply(update.message, msg)
+
+async def cmd_health(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not allowed(update): return
+    lines = ["🩺 Sức khỏe sàn (state | err | p95 | hedge/win):"]
+    for src in PROVIDERS:
+        h = HEALTH.get(src)
+        if not h:
+            lines.append(f"• {provider_display_name(src):<14} chưa gọi"); continue
+        p95 = latency_p95(src)
+        p95s = f"{p95*1000:.0f}ms" if p95 is not None else "-"
+        lines.append(f"• {provider_display_name(src):<14} {h['state']} | {h['err']:.0%} | {p95s} | {h['hedged']}/{h['hedge_wins']}")
+    await safe_reply(update.message, "\n".join(lines))
+
+async def cmd_usage(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Admin: chi phí fetch/gửi theo chat, sắp theo tổng chi phí."""
+    if not is_admin(update): return
+    alerts = load_data().get("alerts", {})
+    cids = set(CHAT_USAGE) | {int(c) for c in alerts}
+    rows = sorted(cids, key=lambda c: usage(c)["fetch_share"] + usage(c)["sends"], reverse=True)
+    lines = [f"📊 Chi phí theo chat (quota: {CHAT_MAX_ALERTS} alert, {CHAT_MAX_BURSTS} burst, "
+             f"{CHAT_MSGS_PER_MIN} tin/phút):"]
+    for cid in rows[:20]:
+        u = usage(cid)
+        lines.append(f"• {cid} (w={chat_weight(cid):g}): alerts={len(alerts.get(str(cid), []))} "
+                     f"fetch={u['fetch_share']:.1f} sent={u['sends']} deferred={u['deferred']} "
+                     f"bursts={u['bursts']} skipped={u['bursts_skipped']} "
+                     f"active={ACTIVE_BURSTS.get(cid, 0)} queued={len(DELIVERY_QUEUES.get(cid, ()))}")
+    await safe_reply(update.message, "\n".join(lines))
+
+def _fmt_tick(node: Dict[str, Any]) -> str:
+    parts = [f"{c['name']} {c['dur']*1000:.0f}" for c in node["children"]]
+    return f"{time.strftime('%H:%M:%S', time.localtime(node['t']))} {node['dur']*1000:.0f}ms: " + ", ".join(parts)
+
+async def cmd_profile(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Admin: /profile [on|off|dump|sample start|sample stop]."""
+    global PROFILE_ON
+    if not is_admin(update): return
+    args = [a.lower() for a in (ctx.args or [])]
+    if args and args[0] in ("on", "off"):
+        PROFILE_ON = args[0] == "on"
+        return await safe_reply(update.message, f"⏱️ Profiling: {args[0]}")
+    if args and args[0] == "dump":
+        try: path = dump_ticks("manual")
+        except Exception as e: return await safe_reply(update.message, f"❌ Không ghi được: {e}")
+        return await safe_reply(update.message, f"💾 Đã ghi {len(TICK_HISTORY)} tick: {path}")
+    if args and args[0] == "sample":
+        if len(args) > 1 and args[1] == "stop":
+            path, top = sampler_stop()
+            if path is None: return await safe_reply(update.message, "Sampler chưa chạy.")
+            lines = [f"🧪 Đã ghi {sum(SAMPLES.values())} mẫu: {path}"] + [f"• {n:>5}  {frame}" for frame, n in top]
+            return await safe_reply(update.message, "\n".join(lines))
+        ok = sampler_start()
+        return await safe_reply(update.message,
+            f"🧪 Sampler chạy mỗi {PROFILE_SAMPLE_MS:g}ms. Dừng: /profile sample stop" if ok else "Sampler đang chạy.")
+
+    lines = [f"⏱️ Profiling: {'on' if PROFILE_ON else 'off'} | giữ {len(TICK_HISTORY)}/{PROFILE_KEEP_TICKS} tick | "
+             f"dump khi tick ≥ {PROFILE_SLOW_TICK_SEC:g}s | sampler: {'on' if _SAMPLER else 'off'}"]
+    for node in list(TICK_HISTORY)[-5:]:
+        lines.append("• " + _fmt_tick(node))
+    with _SPAN_LOCK:
+        stats = sorted(SPAN_STATS.items(), key=lambda kv: kv[1][1], reverse=True)[:8]
+    if stats:
+        lines.append("Span (n | avg | max ms):")
+        for name, (n, total, mx) in stats:
+            lines.append(f"• {name:<16} {n:>6} | {total/n*1000:7.1f} | {mx*1000:7.1f}")
+    lines.append("Dùng: /profile on|off|dump|sample [stop]")
+    await safe_reply(update.message, "\n".join(lines))
 
 async def cmd_price(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not allowed(update): return
     if not ctx.args: return await safe_reply(update.message, "Usage: /price <asset>")
     query = " ".join(ctx.args)
     try:
-        src, code, disp = resolve_asset(query)
-        price = get_price_resolved(src, code)
+        with charge_to(update.effective_chat.id):
+            src, code, disp = await asyncio.to_thread(resolve_asset, query)
+            price = await hub_fetch(src, code)
         await safe_reply(update.message, f"💱 {disp} = {price}")
     except Exception as e:
         await safe_reply(update.message,
@@ -536,13 +1186,13 @@ async def cmd_find(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if c not in seen:
             uniq.append(c); seen.add(c)
 
+    with charge_to(update.effective_chat.id):
+        prices = await asyncio.gather(*(hub_fetch(src, code) for src, code in uniq), return_exceptions=True)
     results=[]
-    for src, code in uniq:
-        try:
-            px = get_price_resolved(src, code)
-            results.append((provider_display_name(src), format_symbol_for_display(src, code), px))
-        except Exception:
+    for (src, code), px in zip(uniq, prices):
+        if isinstance(px, BaseException):
             continue
+        results.append((provider_display_name(src), format_symbol_for_display(src, code), px))
 
     if not results:
         return await safe_reply(update.message, "❌ Không tìm thấy giá trên các sàn.")
@@ -556,9 +1206,7 @@ async def cmd_find(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 def parse_add(args: List[str]) -> Optional[Tuple[str,str,float]]:
     # Cho phép: <asset> >= <price> ; asset có thể gồm 1-2 phần (prefix + symbol)
     if len(args) < 3: return None
-    op_idx = 1
-    if len(args) >= 4 and args[1] not in (">=","<="):
-        op_idx = 2
+    op_idx = next((i for i in range(1, len(args)-1) if args[i] in (">=","<=")), 1)
     asset = " ".join(args[:op_idx])
     op = args[op_idx]
     if op not in (">=","<="): return None
@@ -572,15 +1220,14 @@ def next_id(alerts: List[Dict[str,Any]]) -> int:
     return 1 + max([a["id"] for a in alerts], default=0)
 
 def migrate_store():
-    d = load_data(); changed=False
+    """Migrate cả store trong 1 lần load/save, bỏ qua nếu đã đúng STORE_SCHEMA.
+    Được hẹn chạy sau post_init (không nằm trên đường boot); trước đó
+    _evaluate_pending tự migrate từng alert nó đọc."""
+    d = load_data()
+    if d.get("schema") == STORE_SCHEMA: return
     for cid, arr in list(d.get("alerts", {}).items()):
-        new=[]
-        for a in arr:
-            ma=migrate_alert(a)
-            if ma: new.append(ma); changed|=(ma is not a)
-            else: changed=True
-        d["alerts"][cid]=new
-    if changed: save_data(d)
+        d["alerts"][cid] = [ma for ma in (migrate_alert(a) for a in arr) if ma]
+    d["schema"] = STORE_SCHEMA; save_data(d)
 
 def migrate_alert(a: Dict[str,Any]) -> Optional[Dict[str,Any]]:
     # Nếu thiếu src/code... loại bỏ
@@ -617,24 +1264,203 @@ async def cmd_add(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     asset, op, val = p
 
     try:
-        src, code, disp = resolve_asset(asset)
-        _ = get_price_resolved(src, code)  # validate sớm
+        with charge_to(update.effective_chat.id):
+            src, code, disp = await asyncio.to_thread(resolve_asset, asset)
+            _ = await hub_fetch(src, code)  # validate sớm
     except Exception as e:
         return await safe_reply(update.message, f"❌ Không thêm được: {e}\nDùng /price để kiểm tra trước.")
 
     cid = str(update.effective_chat.id)
     d = load_data(); d["alerts"].setdefault(cid, [])
+    if CHAT_MAX_ALERTS > 0 and len(d["alerts"][cid]) >= CHAT_MAX_ALERTS:
+        return await safe_reply(update.message, f"❌ Chat này đã đạt giới hạn {CHAT_MAX_ALERTS} cảnh báo.")
     new = {"id": next_id(d["alerts"][cid]), "src": src, "code": code, "display": disp,
            "op": op, "value": val, "triggered": False, "last_price": None,
            "last_fired": 0, "last_call": 0, "ack": False}
     d["alerts"][cid].append(new); save_data(d)
     await safe_reply(update.message, f"✅ Đã thêm #{new['id']}: {disp} {op} {val}")
 
+# ===== Bulk add / import / export =====
+IMPORT_MAX_BYTES = 1_000_000
+# Chỉ tải snapshot cả sàn khi batch cần ≥ ngần này asset có thể dò trên sàn đó; ít hơn thì hỏi lẻ
+IMPORT_SNAPSHOT_MIN = int(os.getenv("IMPORT_SNAPSHOT_MIN", "5"))
+
+def parse_bulk_text(text: str) -> Tuple[List[Tuple[str,str,float]], List[str]]:
+    """Mỗi dòng (hoặc ngăn bằng ';') một lệnh dạng /add: <asset> >=|<= <giá>."""
+    rows=[]; errs=[]
+    for ln in re.split(r"[\n;]+", text or ""):
+        ln = ln.strip()
+        if not ln or ln.startswith("#"): continue
+        p = parse_add(ln.split())
+        if p: rows.append(p)
+        else: errs.append(f"'{ln}': sai cú pháp")
+    return rows, errs
+
+def parse_import_file(name: str, data: bytes) -> Tuple[List[Tuple[str,str,float]], List[str]]:
+    """JSON: [{"asset"|"src"+"code", "op", "value"}, ...] (như /export); CSV: asset,op,value."""
+    text = data.decode("utf-8-sig")
+    rows=[]; errs=[]
+    if name.lower().endswith(".json"):
+        items = json.loads(text)
+        if isinstance(items, dict): items = items.get("alerts", [])
+        for i, it in enumerate(items, 1):
+            try:
+                asset = it.get("asset") or f"{it['src']}:{it['code']}"
+                p = parse_add([str(asset), str(it["op"]), str(it["value"])])
+            except Exception:
+                p = None
+            if p: rows.append(p)
+            else: errs.append(f"#{i}: thiếu/sai asset, op, value")
+        return rows, errs
+    first = True
+    for i, rec in enumerate(csv.reader(io.StringIO(text)), 1):
+        rec = [c.strip() for c in rec]
+        if not any(rec): continue
+        if first:
+            first = False
+            if rec[0].lower() == "asset": continue  # header (dòng không rỗng đầu tiên)
+        p = parse_add(rec[:3]) if len(rec) >= 3 else None
+        if p: rows.append(p)
+        else: errs.append(f"dòng {i}: sai cú pháp")
+    return rows, errs
+
+def asset_source(raw: str) -> Optional[str]:
+    """Sàn được chỉ định trong asset (cùng quy tắc với resolve_asset), None nếu để bot tự dò."""
+    x = raw.strip()
+    if ":" in x: return normalize_prefix(x.split(":",1)[0])
+    parts = x.split()
+    return normalize_prefix(parts[0]) if len(parts) >= 2 else None
+
+async def add_alerts_batch(cid: str, rows: List[Tuple[str,str,float]]) -> Tuple[List[Dict[str,Any]], int, List[str]]:
+    """Thêm nhiều cảnh báo: dedupe asset, lấy snapshot cho sàn được cần nhiều, resolve song
+    song rồi ghi store 1 lần. Trả (alert đã thêm, số dòng trùng bỏ qua, lỗi)."""
+    assets = list(dict.fromkeys(a for a, _, _ in rows))
+    # Asset không prefix có thể phải dò trên mọi sàn
+    need: Counter = Counter()
+    for a in assets:
+        src = asset_source(a)
+        need.update([src] if src else list(PROVIDERS))
+    srcs = sorted(src for src, n in need.items() if src in PROVIDERS and n >= IMPORT_SNAPSHOT_MIN)
+    res = await asyncio.gather(*(asyncio.to_thread(fetch_snapshot, src) for src in srcs), return_exceptions=True)
+    snaps = {src: r for src, r in zip(srcs, res) if not isinstance(r, BaseException)}
+    with _USAGE_LOCK:
+        usage(int(cid))["fetch_share"] += sum(1 for r in res if not isinstance(r, CircuitOpen))
+
+    def probe(src: str, code: str) -> float:
+        snap = snaps.get(src)
+        if snap is None:
+            return get_price_resolved(src, code)  # không tải / snapshot lỗi: hỏi lẻ từng cặp
+        return snap[code]
+
+    with charge_to(int(cid)):
+        resolved = await asyncio.gather(*(asyncio.to_thread(resolve_asset, a, probe) for a in assets),
+                                        return_exceptions=True)
+    by_asset = dict(zip(assets, resolved))
+
+    errs: Dict[str, str] = {}
+    added: List[Dict[str,Any]] = []
+    skipped = 0
+    d = load_data(); arr = d["alerts"].setdefault(cid, [])
+    existing = {(a.get("src"), a.get("code"), a.get("op"), a.get("value")) for a in arr}
+    nid = next_id(arr)
+    for asset, op, val in rows:
+        r = by_asset[asset]
+        if isinstance(r, BaseException):
+            errs.setdefault(asset, f"{asset}: {r}"); continue
+        src, code, disp = r
+        key = (src, code, op, val)
+        if key in existing:
+            skipped += 1; continue
+        if CHAT_MAX_ALERTS > 0 and len(arr) >= CHAT_MAX_ALERTS:
+            errs["__quota__"] = f"Đạt giới hạn {CHAT_MAX_ALERTS} cảnh báo, bỏ qua phần còn lại."
+            break
+        new = {"id": nid, "src": src, "code": code, "display": disp,
+               "op": op, "value": val, "triggered": False, "last_price": None,
+               "last_fired": 0, "last_call": 0, "ack": False}
+        nid += 1; arr.append(new); added.append(new); existing.add(key)
+    if added: save_data(d)
+
+    # Ghi giá snapshot vào hub sau khi commit: cache ấm + alert mới được đánh giá ngay
+    for key in dict.fromkeys((a["src"], a["code"]) for a in added):
+        px = snaps.get(key[0], {}).get(key[1])
+        if px is not None: hub_publish(key[0], key[1], px)
+    return added, skipped, list(errs.values())
+
+async def _reply_bulk(update: Update, rows: List[Tuple[str,str,float]], errs: List[str]):
+    if not rows:
+        return await safe_reply(update.message, "❌ Không có dòng hợp lệ.\n" + "\n".join(errs[:10]))
+    added, skipped, errs2 = await add_alerts_batch(str(update.effective_chat.id), rows)
+    errs = errs + errs2
+    msg = f"✅ Đã thêm {len(added)} cảnh báo"
+    if added: msg += f" (#{added[0]['id']}–#{added[-1]['id']})"
+    if skipped: msg += f"\n↩️ Bỏ qua {skipped} cảnh báo trùng"
+    if errs:
+        msg += f"\n❌ {len(errs)} lỗi:\n" + "\n".join(errs[:10])
+        if len(errs) > 10: msg += f"\n… và {len(errs)-10} lỗi khác"
+    await safe_reply(update.message, msg)
+
+async def cmd_addmany(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not allowed(update): return
+    parts = (update.message.text or "").split(None, 1)
+    rows, errs = parse_bulk_text(parts[1] if len(parts) > 1 else "")
+    if not rows and not errs:
+        return await safe_reply(update.message,
+            "Cú pháp (mỗi dòng 1 cảnh báo):\n"
+            "/addmany\n"
+            "BTC >= 70000\n"
+            "binance:ETH <= 2400\n"
+            "kucoin:SOL-USDT >= 150\n\n"
+            "Hoặc gửi file .csv (asset,op,value) / .json (như /export) kèm caption /addmany, "
+            "hoặc trả lời (reply) tin nhắn này bằng file."
+        )
+    await _reply_bulk(update, rows, errs)
+
+def is_import_request(update: Update, bot_id: int) -> bool:
+    """File chỉ được nhập khi có caption /addmany hoặc là reply vào tin hướng dẫn /addmany của bot."""
+    msg = update.message
+    words = (msg.caption or "").split()
+    if words and words[0].split("@")[0].lower() == "/addmany":
+        return True
+    reply = msg.reply_to_message
+    return bool(reply and reply.from_user and reply.from_user.id == bot_id and "/addmany" in (reply.text or ""))
+
+async def on_import_file(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not allowed(update): return
+    if not is_import_request(update, ctx.bot.id): return
+    doc = update.message.document
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        return await safe_reply(update.message, "❌ File quá lớn (tối đa 1MB).")
+    try:
+        f = await doc.get_file()
+        rows, errs = parse_import_file(doc.file_name or "", bytes(await f.download_as_bytearray()))
+    except Exception as e:
+        return await safe_reply(update.message, f"❌ File không hợp lệ: {e}")
+    await _reply_bulk(update, rows, errs)
+
+async def cmd_export(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not allowed(update): return
+    cid = str(update.effective_chat.id); arr = load_data()["alerts"].get(cid, [])
+    if not arr: return await safe_reply(update.message, "Chưa có cảnh báo nào.")
+    fmt = "csv" if ctx.args and ctx.args[0].lower() == "csv" else "json"
+    items = [{"asset": f"{a['src']}:{a['code']}", "op": a["op"], "value": a["value"],
+              "display": a.get("display")} for a in arr]
+    if fmt == "csv":
+        buf = io.StringIO(); w = csv.writer(buf)
+        w.writerow(["asset","op","value"])
+        for it in items: w.writerow([it["asset"], it["op"], it["value"]])
+        data = buf.getvalue().encode("utf-8")
+    else:
+        data = json.dumps(items, ensure_ascii=False, indent=2).encode("utf-8")
+    try:
+        await update.message.reply_document(document=io.BytesIO(data), filename=f"alerts_{cid}.{fmt}")
+    except Exception as e:
+        await safe_reply(update.message, f"❌ Không gửi được file: {e}")
+
 async def cmd_list(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not allowed(update): return
     d = load_data(); arr = d["alerts"].get(str(update.effective_chat.id), [])
     if not arr: return await safe_reply(update.message, "Chưa có cảnh báo nào.")
-    s = "\n".join([f"#{a['id']}: {a['display']} {a['op']} {a['value']} (fired={a['triggered']}, ack={a.get('ack',False)})" for a in arr])
+    s = "\n".join([f"#{a['id']}: {a.get('display', a.get('code'))} {a.get('op')} {a.get('value')} (fired={a.get('triggered',False)}, ack={a.get('ack',False)})" for a in arr])
     await safe_reply(update.message, "Danh sách cảnh báo:\n"+s)
 
 async def cmd_remove(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -698,23 +1524,66 @@ async def on_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 except Exception: pass
                 return
 
-# ===== Job =====
-async def price_job(context: ContextTypes.DEFAULT_TYPE):
-    now=time.time(); d=load_data()
-    groups: Dict[Tuple[str,str], List[Dict[str,Any]]] = {}
+# ===== Alert evaluation (subscriber của hub) =====
+# Giá publish vào hub được gom lại (debounce): flush sau EVAL_DEBOUNCE_SEC yên lặng,
+# nhưng không trễ quá EVAL_MAX_DELAY_SEC kể từ giá đầu tiên; mỗi flush load/save store 1 lần.
+# Producer chạy theo lô (price_job) gọi flush_alert_eval() ngay khi xong lô.
+EVAL_DEBOUNCE_SEC = float(os.getenv("EVAL_DEBOUNCE_SEC", "0.3"))
+EVAL_MAX_DELAY_SEC = float(os.getenv("EVAL_MAX_DELAY_SEC", "2"))
+EVAL_PENDING: Dict[Tuple[str,str], Tuple[float,float]] = {}
+_EVAL_LOCK = threading.Lock()
+_EVAL_APP: Optional[Application] = None
+_EVAL_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_EVAL_TIMER: Optional[asyncio.TimerHandle] = None
+_EVAL_FIRST = 0.0
+
+def bind_alert_evaluator(app: Application):
+    global _EVAL_APP, _EVAL_LOOP
+    _EVAL_APP = app
+    _EVAL_LOOP = asyncio.get_running_loop()
+    hub_subscribe(on_price_alerts)
+
+def on_price_alerts(src: str, code: str, price: float, ts: float):
+    if _EVAL_LOOP is None: return
+    with _EVAL_LOCK:
+        EVAL_PENDING[(src, code)] = (price, ts)
+    _EVAL_LOOP.call_soon_threadsafe(_schedule_flush, context=contextvars.Context())
+
+def _schedule_flush():
+    """Chạy trên event loop: (re)đặt timer flush theo cửa sổ debounce."""
+    global _EVAL_TIMER, _EVAL_FIRST
+    now = _EVAL_LOOP.time()
+    if _EVAL_TIMER is None:
+        _EVAL_FIRST = now
+    else:
+        _EVAL_TIMER.cancel()
+    delay = min(EVAL_DEBOUNCE_SEC, max(0.0, _EVAL_FIRST + EVAL_MAX_DELAY_SEC - now))
+    _EVAL_TIMER = _EVAL_LOOP.call_later(delay, flush_alert_eval)
+
+def flush_alert_eval():
+    global _EVAL_TIMER
+    if _EVAL_TIMER is not None:
+        _EVAL_TIMER.cancel(); _EVAL_TIMER = None
+    with _EVAL_LOCK:
+        pending = dict(EVAL_PENDING); EVAL_PENDING.clear()
+    if not pending or _EVAL_APP is None: return
+    with span("evaluate"):
+        fires = _evaluate_pending(pending)
+    with span("enqueue sends"):
+        for chat_id, text, alert_id in fires:
+            _EVAL_APP.create_task(send_burst(_EVAL_APP.bot, chat_id, text, alert_id))
+
+def _evaluate_pending(pending: Dict[Tuple[str,str], Tuple[float,float]]) -> List[Tuple[int,str,int]]:
+    """Đánh giá alert theo giá mới, lưu store; trả danh sách burst cần gửi."""
+    with span("load"):
+        now=time.time(); d=load_data()
+    fires: List[Tuple[int,str,int]] = []
     for chat_id, arr in d.get("alerts", {}).items():
         for a in arr:
-            if not all(k in a for k in ("src","code","op","value")): continue
-            groups.setdefault((a["src"], a["code"]), []).append({"chat_id": chat_id, "alert": a})
-
-    for (src, code), items in groups.items():
-        try:
-            price = get_price_resolved(src, code)
-        except Exception:
-            continue
-
-        for item in items:
-            chat_id = item["chat_id"]; a=item["alert"]
+            if migrate_alert(a) is None: continue  # store có thể chưa migrate xong
+            hit = pending.get((a["src"], a["code"]))
+            if hit is None: continue
+            price = hit[0]
             a["last_price"]=price
 
             cond = (price >= a["value"]) if a["op"]==">=" else (price <= a["value"])
@@ -728,82 +1597,206 @@ async def price_job(context: ContextTypes.DEFAULT_TYPE):
             elif cond and not a.get("ack",False) and (now - a.get("last_fired",0) >= ALARM_COOLDOWN_SEC):
                 should_fire=True
 
-            if should_fire:
+            if should_fire and burst_reserve(int(chat_id)):
                 a["triggered"]=True
                 a["last_fired"]=now
-                save_data(d)
                 text=f"🚨 {a['display']} {a['op']} {a['value']} — Giá: {price}"
-                context.application.create_task(
-                    send_burst(context.bot, int(chat_id), text, a["id"])
-                )
+                fires.append((int(chat_id), text, a["id"]))
+
+    with span("save"):
+        save_data(d)
+    return fires
+
+# ===== Job =====
+def pair_watchers(d: Dict[str,Any]) -> Dict[Tuple[str,str], List[str]]:
+    """(src, code) -> danh sách chat đang theo dõi cặp đó."""
+    out: Dict[Tuple[str,str], List[str]] = {}
+    for cid, arr in d.get("alerts", {}).items():
+        for a in arr:
+            if not all(k in a for k in ("src","code","op","value")): continue
+            lst = out.setdefault((a["src"], a["code"]), [])
+            if not lst or lst[-1] != cid:
+                lst.append(cid)
+    return out
+
+def watched_pairs(d: Dict[str,Any]) -> List[Tuple[str,str]]:
+    """Các cặp cần fetch, xen kẽ round-robin giữa các chat để chat nhiều alert
+    không chiếm hết hàng đợi fetch của cả tick."""
+    per_chat: List[List[Tuple[str,str]]] = []
+    for arr in d.get("alerts", {}).values():
+        keys = [(a["src"], a["code"]) for a in arr if all(k in a for k in ("src","code","op","value"))]
+        if keys: per_chat.append(keys)
+    seen=set(); out=[]
+    for i in range(max((len(k) for k in per_chat), default=0)):
+        for keys in per_chat:
+            if i < len(keys) and keys[i] not in seen:
+                out.append(keys[i]); seen.add(keys[i])
+    return out
 
-    save_data(d)
+async def _fetch_exchange(src: str, codes: List[str]):
+    with span(f"fetch {src}"):
+        await asyncio.gather(*(hub_fetch(src, code, replay=True, hedge=True) for code in codes),
+                             return_exceptions=True)
+
+async def price_job(context: ContextTypes.DEFAULT_TYPE):
+    """Producer: lấy giá mọi cặp đang theo dõi; việc đánh giá do subscriber làm."""
+    global PAIR_WATCHERS
+    with span("tick", root=True) as tick:
+        with span("load"):
+            d = load_data()
+        with span("group"):
+            PAIR_WATCHERS = {k: [int(c) for c in v] for k, v in pair_watchers(d).items()}
+            by_src: Dict[str, List[str]] = {}
+            for src, code in watched_pairs(d):
+                by_src.setdefault(src, []).append(code)
+        await asyncio.gather(*(_fetch_exchange(src, codes) for src, codes in by_src.items()))
+        # Hết lô: flush phần giá còn chờ debounce ngay (nằm trong span của tick)
+        flush_alert_eval()
+    if tick is not None:
+        record_tick(tick)
 
 # ===== Post-init =====
-async def post_init(app: Application):
+def bot_commands() -> List[Tuple[Any, List[Any]]]:
+    from telegram import BotCommand, BotCommandScopeAllPrivateChats, BotCommandScopeAllGroupChats
     cmds_private = [
         BotCommand("help","Help"), BotCommand("id","Show chat_id"),
         BotCommand("price","Quick price"), BotCommand("find","Find across exchanges"),
-        BotCommand("add","Add alert"), BotCommand("list","List alerts"),
+        BotCommand("add","Add alert"), BotCommand("addmany","Add many alerts"),
+        BotCommand("export","Export alerts"), BotCommand("list","List alerts"),
         BotCommand("remove","Remove by ID"), BotCommand("removeall","Remove all"),
         BotCommand("ack","Acknowledge"), BotCommand("unack","Un-acknowledge"),
-        BotCommand("ping","Health check"),
+        BotCommand("ping","Health check"), BotCommand("health","Exchange health"),
     ]
-    await app.bot.set_my_commands(cmds_private, scope=BotCommandScopeAllPrivateChats())
     cmds_group = [
         BotCommand("price","Quick price"), BotCommand("find","Find across exchanges"),
-        BotCommand("add","Add alert"),
+        BotCommand("add","Add alert"), BotCommand("addmany","Add many alerts"),
+        BotCommand("export","Export alerts"),
         BotCommand("list","List alerts"), BotCommand("remove","Remove"),
         BotCommand("removeall","Remove all"), BotCommand("ack","Acknowledge"),
         BotCommand("unack","Un-acknowledge"), BotCommand("ping","Health check"),
     ]
-    await app.bot.set_my_commands(cmds_group, scope=BotCommandScopeAllGroupChats())
+    return [(BotCommandScopeAllPrivateChats(), cmds_private), (BotCommandScopeAllGroupChats(), cmds_group)]
+
+def commands_hash(spec: List[Tuple[Any, List[Any]]]) -> str:
+    # Gắn bot id vào hash: đổi token sang bot khác thì đăng ký lại
+    raw = json.dumps([BOT_TOKEN.split(":")[0]] +
+                     [[type(scope).__name__, [[c.command, c.description] for c in cmds]] for scope, cmds in spec])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+async def register_commands(app: Application, force: bool = False):
+    """set_my_commands chỉ khi danh sách lệnh đổi so với hash đã lưu trong store."""
+    spec = bot_commands(); h = commands_hash(spec)
+    if not force and load_data().get("commands_hash") == h: return
+    try:
+        for scope, cmds in spec:
+            await app.bot.set_my_commands(cmds, scope=scope)
+    except Exception:
+        return  # lần boot sau thử lại
+    d = load_data(); d["commands_hash"] = h; save_data(d)
+
+async def post_init(app: Application):
+    bind_alert_evaluator(app)
+    # Không chờ: migrate chạy 1 lần ở vòng lặp kế tiếp, đăng ký lệnh chạy nền
+    asyncio.get_running_loop().call_soon(migrate_store)
+    app.create_task(register_commands(app))
 
 async def unknown(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.message and update.message.text and update.message.text.startswith("/"):
         await safe_reply(update.message, "❓ Lệnh không hợp lệ. Gõ /help để xem hướng dẫn.")
 
 # ===== Main =====
-def main():
+async def profile_startup(app: Application):
+    """--profile-startup: chạy các bước boot còn lại (không polling) để đo thời gian."""
+    with startup_phase("app.initialize (getMe)"):
+        await app.initialize()
+    try:
+        with startup_phase("migrate_store"):
+            migrate_store()
+        with startup_phase("register_commands"):
+            await register_commands(app)
+        with startup_phase("first fetch (import requests)"):
+            pairs = watched_pairs(load_data())[:1]
+            if pairs:
+                try: await hub_fetch(*pairs[0])
+                except Exception: pass
+            else:
+                http_session()
+    finally:
+        await app.shutdown()
+
+def main(argv: Optional[List[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    profile = "--profile-startup" in argv
+    STARTUP_PHASES.insert(0, ("module import", time.perf_counter() - _BOOT_T0))
     if not BOT_TOKEN:
         raise SystemExit("BOT_TOKEN is empty (.env)")
 
-    # Tạo request với timeout nếu có HTTPXRequest (PTB >= v20)
-    request = None
-    if _HAS_HTTPX:
-        request = _HTTPXRequest(
-            read_timeout=30.0,
-            connect_timeout=10.0,
-            write_timeout=30.0,
-            pool_timeout=5.0,
+    with startup_phase("import telegram"):
+        from telegram.ext import (
+            Application, CommandHandler, MessageHandler, filters, JobQueue,
+            CallbackQueryHandler
         )
-
-    # Defaults (timeout chung) nếu phiên bản hỗ trợ
-    defaults = _Defaults(timeout=30) if _HAS_DEFAULTS else None
-
-    migrate_store()
-    builder = Application.builder().token(BOT_TOKEN)
-    if request is not None:
-        builder = builder.request(request)
-    if defaults is not None:
-        builder = builder.defaults(defaults)
-
-    app = builder.post_init(post_init).build()
-
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("help", cmd_help))
-    app.add_handler(CommandHandler("id", cmd_id))
-    app.add_handler(CommandHandler("ping", cmd_ping))
-    app.add_handler(CommandHandler("price", cmd_price))
-    app.add_handler(CommandHandler("find", cmd_find))
-    app.add_handler(CommandHandler("add", cmd_add))
-    app.add_handler(CommandHandler("list", cmd_list))
-    app.add_handler(CommandHandler("remove", cmd_remove))
-    app.add_handler(CommandHandler("removeall", cmd_removeall))
-    app.add_handler(CommandHandler("ack", cmd_ack))
-    app.add_handler(CommandHandler("unack", cmd_unack))
-    app.add_handler(CallbackQueryHandler(on_callback, pattern=r"^(ack|unack):\d+$"))
-    app.add_handler(MessageHandler(filters.COMMAND, unknown))
+        # ===== Tùy phiên bản: Defaults / HTTPXRequest có thể không tồn tại =====
+        try:
+            from telegram import Defaults as _Defaults
+            _HAS_DEFAULTS = True
+        except Exception:
+            _HAS_DEFAULTS = False
+        try:
+            from telegram.request import HTTPXRequest as _HTTPXRequest
+            _HAS_HTTPX = True
+        except Exception:
+            _HAS_HTTPX = False
+
+    with startup_phase("build application"):
+        # Tạo request với timeout nếu có HTTPXRequest (PTB >= v20)
+        request = None
+        if _HAS_HTTPX:
+            request = _HTTPXRequest(
+                read_timeout=30.0,
+                connect_timeout=10.0,
+                write_timeout=30.0,
+                pool_timeout=5.0,
+            )
+
+        # Defaults (timeout chung) nếu phiên bản hỗ trợ
+        defaults = _Defaults(timeout=30) if _HAS_DEFAULTS else None
+
+        builder = Application.builder().token(BOT_TOKEN)
+        if request is not None:
+            builder = builder.request(request)
+        if defaults is not None:
+            builder = builder.defaults(defaults)
+
+        app = builder.post_init(post_init).build()
+
+    with startup_phase("register handlers"):
+        app.add_handler(CommandHandler("start", cmd_start))
+        app.add_handler(CommandHandler("help", cmd_help))
+        app.add_handler(CommandHandler("id", cmd_id))
+        app.add_handler(CommandHandler("ping", cmd_ping))
+        app.add_handler(CommandHandler("health", cmd_health))
+        app.add_handler(CommandHandler("usage", cmd_usage))
+        app.add_handler(CommandHandler("profile", cmd_profile))
+        app.add_handler(CommandHandler("price", cmd_price))
+        app.add_handler(CommandHandler("find", cmd_find))
+        app.add_handler(CommandHandler("add", cmd_add))
+        app.add_handler(CommandHandler("addmany", cmd_addmany))
+        app.add_handler(CommandHandler("export", cmd_export))
+        app.add_handler(CommandHandler("list", cmd_list))
+        app.add_handler(CommandHandler("remove", cmd_remove))
+        app.add_handler(CommandHandler("removeall", cmd_removeall))
+        app.add_handler(CommandHandler("ack", cmd_ack))
+        app.add_handler(CommandHandler("unack", cmd_unack))
+        app.add_handler(CallbackQueryHandler(on_callback, pattern=r"^(ack|unack):\d+$"))
+        app.add_handler(MessageHandler(filters.Document.FileExtension("csv") | filters.Document.FileExtension("json"),
+                                       on_import_file))
+        app.add_handler(MessageHandler(filters.COMMAND, unknown))
+
+    if profile:
+        asyncio.run(profile_startup(app))
+        print(startup_report())
+        return
 
     # Job queue
     if app.job_queue is None: